@@ -2,11 +2,76 @@
 from splunklib.searchcommands import dispatch, StreamingCommand, Configuration, Option, validators
 from openai import OpenAI
 from dotenv import load_dotenv
+import httpx
+import functools
 import os
 import json
 import re
 import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from heapq import heappush, heappop
+
+# orjsonがあればC実装でシリアライズする (UTF-8出力なのでensure_ascii不要)
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, ensure_ascii=False)
+
+    _loads = json.loads
+
+# tiktokenがあれば送信前にトークン数を正確に見積もる (なければ文字数で近似)
+try:
+    import tiktoken
+
+    @functools.lru_cache(maxsize=8)
+    def _encoder(model):
+        # エンコーダ構築は高コストなのでモデルごとにキャッシュする
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+
+    def _count_tokens(text, model):
+        return len(_encoder(model).encode(text))
+except ImportError:
+    def _count_tokens(text, model):
+        # ざっくり 1トークン ≒ 3文字 とみなす
+        return len(text) // 3
+
+# .envはモジュールロード時に一度だけ読む (ディスパッチごとの再パースを避ける)
+load_dotenv()
+_API_KEY = os.getenv("OPENAI_API_KEY")
+_MODEL = os.getenv("OPENAI_MODEL")
+
+# プロセス内で1つだけ持つOpenAIクライアント (httpxの接続プールを使い回す)
+_CLIENT = None
+
+
+def _get_client():
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = OpenAI(
+            api_key=_API_KEY,
+            http_client=httpx.Client(
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+                timeout=httpx.Timeout(60.0, connect=5.0),
+            ),
+        )
+    return _CLIENT
+
+
+@functools.lru_cache(maxsize=64)
+def _compile(pattern):
+    # redactパターンのコンパイル結果をディスパッチをまたいで共有する
+    return re.compile(pattern)
+
 
 @Configuration()
 class OpenAIInsightCommand(StreamingCommand):
@@ -16,54 +81,109 @@ class OpenAIInsightCommand(StreamingCommand):
     batch_size = Option(name="batch_size", require=False, default=50, validate=validators.Integer(minimum=1, maximum=500))
     window_sec = Option(name="window_sec", require=False, validate=validators.Integer(minimum=0))
     redact = Option(name="redact", require=False, default="(?i)(api[_-]?key|password|token)=\\S+")
+    use_batch_api = Option(name="use_batch_api", require=False, default=False, validate=validators.Boolean())
+    groups_per_call = Option(name="groups_per_call", require=False, default=8, validate=validators.Integer(minimum=1, maximum=64))
 
-    def stream(self, records):
-        # .envをロード
-        load_dotenv()
+    # OpenAI Batch APIジョブのポーリング間隔(秒)
+    BATCH_POLL_SEC = 30
+    # まとめ送り時のユーザプロンプト上限(文字数ベースの安全弁)
+    MAX_PROMPT_CHARS = 400000
+    # 1リクエストあたりのユーザプロンプトのトークン上限
+    MAX_PROMPT_TOKENS = 100000
 
-        # APIキーとモデル名を.envから取得
-        api_key = os.getenv("OPENAI_API_KEY")
-        model_name = os.getenv("OPENAI_MODEL")
+    def stream(self, records):
+        # APIキーとモデル名はモジュールロード時に.envから取得済み
+        api_key = _API_KEY
+        model_name = _MODEL
 
         if not api_key:
             raise ValueError("OPENAI_API_KEY is not set. Please check your .env file.")
         if not model_name:
             raise ValueError("OPENAI_MODEL is not set. Please check your .env file.")
 
-        client = OpenAI(api_key=api_key)
+        client = _get_client()
 
         field_list = [f.strip() for f in self.fields.split(",") if f.strip()]
+        field_set = set(field_list)
         group_field = self.group_by.strip() if self.group_by else None
-        redact_re = re.compile(self.redact) if self.redact else None
+        redact_re = _compile(self.redact) if self.redact else None
+        redact_sub = redact_re.sub if redact_re else None
 
         buffers = defaultdict(list)
-        first_ts = {}
-
-        def flush(key):
-            batch = buffers[key]
-            if not batch:
-                return []
-            # データをJSON化
-            items = []
-            for r in batch:
-                item = {f: r.get(f, "") for f in field_list}
-                if redact_re:
-                    for k, v in item.items():
-                        if isinstance(v, str):
-                            item[k] = redact_re.sub(r"\1=***", v)
-                items.append(item)
+        window_sec = int(self.window_sec) if self.window_sec else None
+        # window_sec用のflushスケジュール: (期限, key) のminヒープ。
+        # 期限はmonotonic時刻。古いエントリはwindow_deadlineとの照合で無効化する
+        deadlines = []
+        window_deadline = {}
 
-            # OpenAIへのリクエスト
+        def build_items(batch):
+            # データをJSON化 (フィールド抽出とredactを1パスで行う)
+            if redact_sub:
+                return [
+                    {f: (redact_sub(r"\1=***", v) if isinstance(v := rec.get(f, ""), str) else v)
+                     for f in field_list}
+                    for rec in batch
+                ]
+            return [{f: rec.get(f, "") for f in field_list} for rec in batch]
+
+        def build_messages(items):
             system_prompt = (
                 "You are a log analyst. Return STRICT JSON with keys: "
                 "insights[], anomalies[], actions[]."
             )
-            user_prompt = json.dumps({
+            user_prompt = _dumps({
                 "mode": self.mode,
                 "sample_count": len(items),
-                "data": items[:self.batch_size]
-            }, ensure_ascii=False)
+                "data": items
+            })
+
+            return [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ]
+
+        def to_result(key, count, out):
+            try:
+                parsed = _loads(out)
+            except Exception:
+                parsed = {"insights":[{"title":"ParseError","detail":out,"confidence":0.3}]}
+
+            return {
+                "_group": key,
+                "_count": count,
+                "insights": _dumps(parsed.get("insights",[])),
+                "anomalies": _dumps(parsed.get("anomalies",[])),
+                "actions": _dumps(parsed.get("actions",[])),
+            }
 
+        def dispatch_groups(groups):
+            # 複数グループ分を1回のAPI呼び出しにまとめる (batch prompting)
+            # custom_idは位置ベースにして同一キーの再flushでも衝突しないようにする
+            system_prompt = (
+                "You are a log analyst. For each entry in `batches`, return STRICT JSON "
+                '{"results": [{"custom_id": ..., "insights": [], "anomalies": [], '
+                '"actions": []}, ...]} with exactly one result per custom_id.'
+            )
+            user_prompt = _dumps({
+                "mode": self.mode,
+                "batches": [
+                    {"custom_id": "g%d" % i, "sample_count": len(items), "data": items}
+                    for i, (key, items) in enumerate(groups)
+                ],
+            })
+
+            # トークン上限を超える場合はグループ(またはアイテム)を二分して再試行
+            if _count_tokens(user_prompt, model_name) > self.MAX_PROMPT_TOKENS:
+                if len(groups) > 1:
+                    mid = len(groups) // 2
+                    return dispatch_groups(groups[:mid]) + dispatch_groups(groups[mid:])
+                key, items = groups[0]
+                if len(items) > 1:
+                    mid = len(items) // 2
+                    return dispatch_groups([(key, items[:mid])]) + dispatch_groups([(key, items[mid:])])
+                # 1アイテムでも超える場合はそのまま送り、API側のエラーに委ねる
+
+            # OpenAIへのリクエスト
             resp = client.chat.completions.create(
                 model=model_name,  # ← .envから取得したモデル名を使用
                 temperature=0.2,
@@ -76,32 +196,184 @@ class OpenAIInsightCommand(StreamingCommand):
 
             out = resp.choices[0].message.content
             try:
-                parsed = json.loads(out)
+                parsed = _loads(out)
+                by_id = {e.get("custom_id"): e for e in parsed.get("results", []) if isinstance(e, dict)}
             except Exception:
-                parsed = {"insights":[{"title":"ParseError","detail":out,"confidence":0.3}]}
+                by_id = {}
+                parse_error = [{"title":"ParseError","detail":out,"confidence":0.3}]
+            else:
+                parse_error = [{"title":"MissingResult","detail":"no result for this group","confidence":0.0}]
 
-            result = {
-                "_group": key,
-                "_count": len(items),
-                "insights": json.dumps(parsed.get("insights",[]), ensure_ascii=False),
-                "anomalies": json.dumps(parsed.get("anomalies",[]), ensure_ascii=False),
-                "actions": json.dumps(parsed.get("actions",[]), ensure_ascii=False),
-            }
-            buffers[key] = []
-            first_ts.pop(key, None)
-            return [result]
-
-        for r in records:
-            key = r.get(group_field, "__all__") if group_field else "__all__"
-            buffers[key].append(r)
-            if key not in first_ts:
-                first_ts[key] = time.time()
-            if len(buffers[key]) >= int(self.batch_size) or (self.window_sec and (time.time()-first_ts[key] >= int(self.window_sec))):
-                for out in flush(key):
-                    yield out
+            rows = []
+            for i, (key, items) in enumerate(groups):
+                entry = by_id.get("g%d" % i)
+                if entry is None:
+                    entry = {"insights": parse_error}
+                rows.append({
+                    "_group": key,
+                    "_count": len(items),
+                    "insights": _dumps(entry.get("insights",[])),
+                    "anomalies": _dumps(entry.get("anomalies",[])),
+                    "actions": _dumps(entry.get("actions",[])),
+                })
+            return rows
+
+        # Batch APIモード用のバッファ (JSONL行とcustom_id→グループの対応)
+        batch_requests = []
+        batch_meta = {}
+
+        def enqueue_batch(key, items):
+            messages = build_messages(items)
+            # 上限超過ならアイテムを二分して別リクエストに分ける
+            if len(items) > 1 and _count_tokens(messages[1]["content"], model_name) > self.MAX_PROMPT_TOKENS:
+                mid = len(items) // 2
+                enqueue_batch(key, items[:mid])
+                enqueue_batch(key, items[mid:])
+                return
+            custom_id = "req-%d" % len(batch_requests)
+            batch_meta[custom_id] = (key, len(items))
+            batch_requests.append(_dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model_name,
+                    "temperature": 0.2,
+                    "response_format": {"type": "json_object"},
+                    "messages": messages,
+                },
+            }))
 
-        for key in list(buffers.keys()):
-            for out in flush(key):
-                yield out
+        def run_batch_job():
+            # 溜めたリクエストをBatch APIに投入し、完了までポーリングする
+            jsonl_bytes = ("\n".join(batch_requests) + "\n").encode("utf-8")
+            upload = client.files.create(
+                purpose="batch",
+                file=("openai_insight_batch.jsonl", jsonl_bytes),
+            )
+            job = client.batches.create(
+                input_file_id=upload.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+            while job.status not in ("completed", "failed", "expired", "cancelled"):
+                time.sleep(self.BATCH_POLL_SEC)
+                job = client.batches.retrieve(job.id)
+
+            if job.status != "completed":
+                detail = _dumps([{"title":"BatchError","detail":"batch job %s" % job.status,"confidence":0.0}])
+                return [
+                    {"_group": key, "_count": count, "insights": detail, "anomalies": "[]", "actions": "[]"}
+                    for key, count in batch_meta.values()
+                ]
+
+            def error_row(key, count, detail):
+                return {
+                    "_group": key,
+                    "_count": count,
+                    "insights": _dumps([{"title":"BatchError","detail":detail,"confidence":0.0}]),
+                    "anomalies": "[]",
+                    "actions": "[]",
+                }
+
+            results = []
+            seen = set()
+            content = client.files.content(job.output_file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                entry = _loads(line)
+                custom_id = entry.get("custom_id")
+                key, count = batch_meta.get(custom_id, ("__all__", 0))
+                seen.add(custom_id)
+                try:
+                    out = entry["response"]["body"]["choices"][0]["message"]["content"]
+                except (KeyError, IndexError, TypeError):
+                    # completion以外のボディ(エラー行など)は1行で吸収する
+                    results.append(error_row(key, count, "malformed batch output line"))
+                    continue
+                results.append(to_result(key, count, out))
+
+            # error_file行きになった失敗リクエストなど、出力ファイルに
+            # 現れなかったリクエストにも必ず1行返す
+            for custom_id, (key, count) in batch_meta.items():
+                if custom_id not in seen:
+                    results.append(error_row(key, count, "no output for this request (see batch error file)"))
+            return results
+
+        # OpenAI呼び出しはI/Oバウンドなのでスレッドプールで並列化する
+        # (openai SDKは共有httpx.Clientを使うためスレッドセーフ)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            pending = set()
+            # flush済みでまとめ送り待ちのグループと、その概算プロンプト長
+            ready_groups = []
+            ready_chars = 0
+
+            def submit_ready():
+                nonlocal ready_chars
+                if not ready_groups:
+                    return
+                groups = list(ready_groups)
+                ready_groups.clear()
+                ready_chars = 0
+                pending.add(executor.submit(dispatch_groups, groups))
+
+            def submit_flush(key):
+                nonlocal ready_chars
+                batch = buffers[key]
+                if not batch:
+                    return
+                buffers[key] = []
+                window_deadline.pop(key, None)
+                items = build_items(batch)
+                if self.use_batch_api:
+                    # Batch APIモードでは即時送信せずJSONLに積む
+                    enqueue_batch(key, items)
+                    return
+                ready_groups.append((key, items))
+                ready_chars += len(_dumps(items))
+                if len(ready_groups) >= int(self.groups_per_call) or ready_chars >= self.MAX_PROMPT_CHARS:
+                    submit_ready()
+
+            for r in records:
+                # 対象フィールドを1つも持たないレコードはバッファしない
+                # (空アイテムのAPI送信を防ぐ)
+                if not field_set.isdisjoint(r):
+                    key = r.get(group_field, "__all__") if group_field else "__all__"
+                    if window_sec and not buffers[key]:
+                        # グループの最初のレコードで期限をスケジュールする
+                        dl = time.monotonic() + window_sec
+                        window_deadline[key] = dl
+                        heappush(deadlines, (dl, key))
+                    buffers[key].append(r)
+                    if len(buffers[key]) >= int(self.batch_size):
+                        submit_flush(key)
+                # 期限が来たグループを、今のkeyに限らずflushする
+                if window_sec:
+                    now = time.monotonic()
+                    while deadlines and deadlines[0][0] <= now:
+                        dl, k = heappop(deadlines)
+                        if window_deadline.get(k) == dl and buffers[k]:
+                            submit_flush(k)
+                # 完了済みのflushがあれば随時yieldする
+                if pending:
+                    done, pending = wait(pending, timeout=0, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        for out in fut.result():
+                            yield out
+
+            for key in list(buffers.keys()):
+                submit_flush(key)
+            submit_ready()
+            if pending:
+                done, _ = wait(pending, return_when=ALL_COMPLETED)
+                for fut in done:
+                    for out in fut.result():
+                        yield out
+
+            # Batch APIモード: 全グループ分をまとめて1ジョブで処理する
+            if batch_requests:
+                for out in run_batch_job():
+                    yield out
 
 dispatch(OpenAIInsightCommand, module_name=__name__)
@@ -3,9 +3,17 @@ import json
 import time
 import os
 import re
-import requests
+import asyncio
+import httpx
 import splunklib.searchcommands as sc
-from splunklib.searchcommands import Configuration, Option, StreamingCommand
+from splunklib.searchcommands import Configuration, Option, StreamingCommand, validators
+
+# Fast JSON parsing for the SSE hot loop; fall back to stdlib json
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
 
 # Load environment variables from .env file
 try:
@@ -19,10 +27,19 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
 
+# Connection pool limits and concurrency cap for the per-batch AsyncClient
+LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+MAX_CONCURRENCY = 32
+
+# Compiled once: matches {field_name} placeholders in the prompt template
+_PLACEHOLDER_RE = re.compile(r'\{([^}]+)\}')
+
 @Configuration()
 class OpenAIStreaming(StreamingCommand):
     # Define `prompt` as an option for the search command
     prompt = Option(require=True)
+    # Emit one event per streamed delta instead of a single aggregate event
+    stream_chunks = Option(require=False, default=False, validate=validators.Boolean())
 
     def stream(self, records):
         """
@@ -59,107 +76,148 @@ class OpenAIStreaming(StreamingCommand):
         Substitute placeholders in the prompt template with values from the record.
         Placeholder format: {field_name}
         """
-        # Find all placeholders in the format {field_name}
-        placeholders = re.findall(r'\{([^}]+)\}', prompt_template)
-        
-        result_prompt = prompt_template
-        for placeholder in placeholders:
-            field_value = record.get(placeholder, f"[FIELD_NOT_FOUND:{placeholder}]")
-            result_prompt = result_prompt.replace(f"{{{placeholder}}}", str(field_value))
-        
-        return result_prompt
+        # Single regex pass over the template; no per-field str.replace scans
+        def _lookup(match):
+            placeholder = match.group(1)
+            return str(record.get(placeholder, f"[FIELD_NOT_FOUND:{placeholder}]"))
+
+        return _PLACEHOLDER_RE.sub(_lookup, prompt_template)
 
     def _process_batch(self, records, headers):
         """
-        Process a batch of records with OpenAI API calls.
+        Process a batch of records with concurrent OpenAI API calls.
         """
-        for record in records:
-            try:
-                # Substitute placeholders in the prompt
-                processed_prompt = self._substitute_placeholders(self.prompt, record)
-                
-                # API request payload
-                data = {
-                    'model': OPENAI_MODEL,
-                    'messages': [
-                        {
-                            'role': 'user',
-                            'content': processed_prompt
-                        }
-                    ],
-                    'stream': True
-                }
+        # Launch all requests of the batch concurrently; results come back
+        # in the original record order (each request may emit several
+        # events in chunked mode)
+        for events in asyncio.run(self._gather(records, headers)):
+            yield from events
 
+    async def _gather(self, records, headers):
+        """
+        Fan out one streaming request per record over a shared AsyncClient,
+        bounded by a semaphore.
+        """
+        sem = asyncio.Semaphore(MAX_CONCURRENCY)
+        # limits must go to the transport: httpx ignores the client-level
+        # limits argument once an explicit transport is given
+        async with httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(retries=2, limits=LIMITS),
+            timeout=httpx.Timeout(120.0, connect=5.0),
+        ) as client:
+            return await asyncio.gather(
+                *[self._one(record, client, sem, headers) for record in records]
+            )
+
+    async def _one(self, record, client, sem, headers):
+        """
+        Send one streaming chat completion request and assemble the result
+        event(s) for it.
+        """
+        # Substitute placeholders in the prompt (also reused on the error path)
+        processed_prompt = self._substitute_placeholders(self.prompt, record)
+
+        try:
+            # API request payload
+            data = {
+                'model': OPENAI_MODEL,
+                'messages': [
+                    {
+                        'role': 'user',
+                        'content': processed_prompt
+                    }
+                ],
+                'stream': True
+            }
+
+            async with sem:
                 # Send a POST request to the OpenAI API with streaming enabled
-                response = requests.post(f"{OPENAI_API_BASE}/chat/completions",
-                                         json=data, headers=headers, stream=True)
-
-                # Set `_time` field as a UNIX timestamp
-                event_time = time.time()
-
-                # Process streaming response
-                openai_response = ""
-                
-                # Parse streaming response line by line
-                for line in response.iter_lines():
-                    if line:
-                        line_text = line.decode('utf-8').strip()
-                        
-                        # Look for lines that start with "data: "
-                        if line_text.startswith("data: "):
-                            data_part = line_text[6:]  # Remove "data: " prefix
-                            
-                            # Check for stream termination
-                            if data_part == "[DONE]":
-                                break
-                            
-                            try:
-                                # Try to parse the JSON data
-                                chunk_data = json.loads(data_part)
-                                
-                                # Extract content from the chunk
-                                if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
-                                    choice = chunk_data["choices"][0]
-                                    if "delta" in choice and "content" in choice["delta"]:
-                                        content = choice["delta"]["content"]
-                                        openai_response += content
-                                        
-                            except json.JSONDecodeError:
-                                # Skip malformed JSON lines
-                                continue
-
-                # Construct event for Splunk
-                result = dict(record)  # Copy original record
+                async with client.stream("POST", f"{OPENAI_API_BASE}/chat/completions",
+                                         json=data, headers=headers) as response:
+                    # Set `_time` field as a UNIX timestamp
+                    event_time = time.time()
+                    status_code = response.status_code
+
+                    # Collected delta contents; joined once after the loop
+                    parts = []
+
+                    # Parse streaming response line by line; httpx already
+                    # decodes and strips line endings, so only a prefix
+                    # check is needed per chunk
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: "):
+                            continue
+                        data_part = line[6:]  # Remove "data: " prefix
+
+                        # Check for stream termination
+                        if data_part == "[DONE]":
+                            break
+
+                        try:
+                            # Try to parse the JSON data
+                            chunk_data = _loads(data_part)
+
+                            # Extract content from the chunk
+                            if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
+                                choice = chunk_data["choices"][0]
+                                if "delta" in choice and "content" in choice["delta"]:
+                                    parts.append(choice["delta"]["content"])
+
+                        except ValueError:
+                            # Skip malformed JSON lines
+                            continue
+
+            # Chunked mode: emit one event per delta so downstream commands
+            # can process incrementally (reassemble with stats by chunk_seq)
+            if self.stream_chunks and status_code == 200:
+                events = []
+                for seq, content in enumerate(parts):
+                    event = dict(record)  # Copy original record
+                    event.update({
+                        "_time": event_time,
+                        "chunk_seq": seq,
+                        "status": "success",
+                        "response_code": status_code,
+                        "openai_response": content,
+                        "model": OPENAI_MODEL
+                    })
+                    events.append(event)
+                return events
+
+            openai_response = "".join(parts)
+
+            # Construct event for Splunk
+            result = dict(record)  # Copy original record
+            result.update({
+                "_time": event_time,
+                "original_prompt": self.prompt,
+                "processed_prompt": processed_prompt,
+                "status": "success" if status_code == 200 else "error",
+                "response_code": status_code,
+                "openai_response": openai_response,
+                "model": OPENAI_MODEL
+            })
+
+            if status_code != 200:
                 result.update({
-                    "_time": event_time,
-                    "original_prompt": self.prompt,
-                    "processed_prompt": processed_prompt,
-                    "status": "success" if response.status_code == 200 else "error",
-                    "response_code": response.status_code,
-                    "openai_response": openai_response,
-                    "model": OPENAI_MODEL
+                    "error_message": f"OpenAI API error: {status_code}"
                 })
 
-                if response.status_code != 200:
-                    result.update({
-                        "error_message": f"OpenAI API error: {response.status_code}"
-                    })
-
-                yield result
-
-            except Exception as e:
-                # Handle exceptions and return error message
-                error_result = dict(record)  # Copy original record
-                error_result.update({
-                    "_time": time.time(),
-                    "original_prompt": self.prompt,
-                    "processed_prompt": self._substitute_placeholders(self.prompt, record),
-                    "status": "exception",
-                    "error_message": str(e),
-                    "openai_response": "",
-                    "model": OPENAI_MODEL
-                })
-                yield error_result
+            return [result]
+
+        except Exception as e:
+            # Handle exceptions and return error message
+            error_result = dict(record)  # Copy original record
+            error_result.update({
+                "_time": time.time(),
+                "original_prompt": self.prompt,
+                "processed_prompt": processed_prompt,
+                "status": "exception",
+                "error_message": str(e),
+                "openai_response": "",
+                "model": OPENAI_MODEL
+            })
+            return [error_result]
 
 # Register the command in Splunk
 if __name__ == "__main__":